@@ -1,5 +1,12 @@
+import hashlib
 import json
+import os
+import pickle
 import sys
+from array import array
+from functools import lru_cache
+
+import orjson
 
 # Usage:
 #   python eval_harness.py /path/to/ground_truth.jsonl /path/to/model_outputs.jsonl
@@ -13,32 +20,72 @@ import sys
 NORM_SEX = {"m":"male","male":"male","f":"female","female":"female","xy":"male","xx":"female"}
 
 FIELDS = ["sex","age","systolic_bp","diastolic_bp","heart_rate","diagnosis","treatment","outcome"]
+INT_FIELDS = ("systolic_bp","diastolic_bp","age","heart_rate")
+BP_FIELDS = ("systolic_bp","diastolic_bp")
 
-def norm(v, field):
-    if v is None:
+def _norm_int(v):
+    try:
+        return int(float(v))
+    except Exception:
         return None
-    if field in ("systolic_bp","diastolic_bp","age","heart_rate"):
-        try:
-            return int(float(v))
-        except Exception:
-            return None
+
+@lru_cache(maxsize=4096)
+def _norm_str(s, field):
+    # few distinct values per categorical field, so this is almost always a cache hit
+    s = s.strip().lower()
     if field == "sex":
-        s = str(v).strip().lower()
         return NORM_SEX.get(s, s)
-    # strings
-    return str(v).strip().lower()
+    return s
+
+def norm(v, field):
+    if v is None:
+        return None
+    if field in INT_FIELDS:
+        return _norm_int(v)
+    # strings (str() first so unhashable junk like lists still works as a cache key)
+    return _norm_str(str(v), field)
 
 def bp_close(a, b, tol=5):
     if a is None or b is None:
         return False
     return abs(a - b) <= tol
 
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "clinical_eval")
+
+# load_jsonl() trimmed to {id: {"ground_truth": ...}}, pickled on disk until the file's mtime/size change
+def load_ground_truth(path):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stamp = (path, st.st_mtime_ns, st.st_size)
+    cache_file = os.path.join(CACHE_DIR, hashlib.sha1(path.encode()).hexdigest() + ".pkl")
+    try:
+        with open(cache_file, "rb") as f:
+            cached_stamp, data = pickle.load(f)
+        if cached_stamp == stamp:
+            return data
+    except Exception:
+        pass  # missing, stale format or unreadable cache: just re-parse
+    data = {rid: {"ground_truth": obj.get("ground_truth", {})} for rid, obj in load_jsonl(path).items()}
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump((stamp, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+    except OSError:
+        pass  # caching is best effort
+    return data
+
 def load_jsonl(path):
     data = {}
-    with open(path, "r", encoding="utf-8") as f:
+    with open(path, "rb") as f:
         for line in f:
             if line.strip():
-                obj = json.loads(line)
+                try:
+                    obj = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # stdlib json also accepts NaN/Infinity, which older runner outputs may contain
+                    obj = json.loads(line)
                 data[str(obj["id"])] = obj
     return data
 
@@ -50,40 +97,50 @@ def macro_f1_from_counts(tp, fp, fn):
         return 0.0
     return 2 * precision * recall / (precision + recall)
 
-def main(gt_path, pred_path):
-    gt_map = load_jsonl(gt_path)
-    pr_map = load_jsonl(pred_path)
-
-    per_field_correct = {f:0 for f in FIELDS}
-    per_field_total = {f:0 for f in FIELDS}
+# returns (per_field_correct, per_field_total, tp, fp, fn)
+def score_records(gt_map, pr_map):
+    per_field_correct = array("l", [0] * len(FIELDS))
+    per_field_total = array("l", [0] * len(FIELDS))
 
     # For a crude F1, treat each exact-field-match as a "label"
     tp = fp = fn = 0
 
+    # bind hot-loop names to locals to skip global/attribute lookups per field
+    _correct, _total, _bp, _norm = per_field_correct, per_field_total, bp_close, norm
+    fields = [(i, f, f in BP_FIELDS) for i, f in enumerate(FIELDS)]
+    empty = {}
+
     for rid, g in gt_map.items():
-        gt = g.get("ground_truth", {})
-        pred = pr_map.get(rid, {}).get("pred", {})
-        for field in FIELDS:
-            gtv = norm(gt.get(field), field)
-            prv = norm(pred.get(field), field)
+        gt = g.get("ground_truth", empty)
+        pred = pr_map.get(rid, empty).get("pred", empty)
+        for i, field, is_bp in fields:
+            gtv = _norm(gt.get(field), field)
             if gtv is None:
                 continue
-            per_field_total[field] += 1
+            prv = _norm(pred.get(field), field)
+            _total[i] += 1
 
-            correct = False
-            if field in ("systolic_bp","diastolic_bp"):
-                correct = bp_close(gtv, prv, tol=5)
+            if is_bp:
+                correct = _bp(gtv, prv, tol=5)
             else:
                 correct = (gtv == prv)
 
             if correct:
-                per_field_correct[field] += 1
+                _correct[i] += 1
                 tp += 1
             else:
                 fn += 1
                 if prv is not None:
                     fp += 1
 
+    return dict(zip(FIELDS, per_field_correct)), dict(zip(FIELDS, per_field_total)), tp, fp, fn
+
+def main(gt_path, pred_path):
+    gt_map = load_ground_truth(gt_path)
+    pr_map = load_jsonl(pred_path)
+
+    per_field_correct, per_field_total, tp, fp, fn = score_records(gt_map, pr_map)
+
     # Accuracy: average over fields present
     totals = sum(per_field_total.values())
     corrects = sum(per_field_correct.values())
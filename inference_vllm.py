@@ -5,50 +5,160 @@ inference_vllm.py
 
 Simple concurrent vLLM Chat Completions runner.
 - Uses the vLLM OpenAI-like endpoint: POST http://host:port/v1/chat/completions
-- Sends batches of concurrent requests (default batch size 50).
+- Keeps up to --batch-size requests in flight (default 50) on one asyncio loop / aiohttp connector.
 - Optionally read only the first N rows via --limit (useful for quick tests).
+- Optionally pack R notes into one request via --rows-per-call (rows the model drops are re-sent alone).
 - Writes output JSONL lines: {"id": "<id>", "pred": <parsed_json_or_empty_dict>}
+- With --resume, ids already in the output file are skipped and new lines are appended.
 - Prints total execution time.
 
+The system message and the template text before {{NOTE_TEXT}} are identical for every
+request, so start the server with prefix caching to prefill that part only once:
+  vllm serve google/gemma-3-270m-it --enable-prefix-caching
+
 Example:
   export VLLM_ENDPOINT=http://127.0.0.1:8000/v1
   export OPENAI_API_KEY=dummy
   python inference_vllm.py --model google/gemma-3-270m-it --out gemma-3-270m-it_outputs.jsonl --limit 10
 
 """
-import argparse, json, os, re, sys, time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse, asyncio, json, logging, os, random, re, sys, time
 from pathlib import Path
-import requests
+import aiohttp
+import orjson
+
+log = logging.getLogger(__name__)
+
+SYSTEM_PROMPT = "You are a medical electronic records expert. Return ONLY a compact JSON object per the rules."
+
+BATCH_INSTRUCTIONS = (
+    "\n\nThe text above is a JSON array of notes, each with an \"id\" and a \"note\". "
+    "Extract every note independently and return ONLY a JSON object of the form "
+    "{\"results\": [{\"id\": \"<id>\", \"pred\": {...}}, ...]} with one entry per note."
+)
+
+# JSON schema for --guided-json, mirroring evaluation.FIELDS; nothing is required
+# because the prompt asks the model to omit unknown fields.
+PRED_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "sex": {"type": "string", "enum": ["male", "female"]},
+        "age": {"type": "integer"},
+        "systolic_bp": {"type": "integer"},
+        "diastolic_bp": {"type": "integer"},
+        "heart_rate": {"type": "integer"},
+        "diagnosis": {"type": "string"},
+        "treatment": {"type": "string"},
+        "outcome": {"type": "string"},
+    },
+    "additionalProperties": False,
+}
+
+BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {"id": {"type": "string"}, "pred": PRED_SCHEMA},
+                "required": ["id", "pred"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["results"],
+    "additionalProperties": False,
+}
+
+_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+_TRAIL_COMMA = re.compile(r",\s*(?=[}\]])")
+_CTRL_TABLE = {c: 0x20 for c in range(0x20)} | {c: 0x20 for c in range(0x7f, 0xa0)}
+
+
+def _repair_loads(text: str, opener: str, closer: str):
+    """Cut text from the first opener to the last closer and parse it leniently; None if that fails."""
+    # strip code fences if present
+    text = _FENCE.sub("", text.strip())
+    s, e = text.find(opener), text.rfind(closer)
+    if s == -1 or e <= s:
+        return None
+    cand = _TRAIL_COMMA.sub("", text[s:e + 1])
+    try:
+        return orjson.loads(cand)
+    except ValueError:
+        pass
+    # stdlib json also accepts NaN/Infinity, which orjson rejects
+    for c in (cand, cand.translate(_CTRL_TABLE)):
+        try:
+            return json.loads(c)
+        except ValueError:
+            pass
+    return None
 
 
 def extract_json(text: str) -> dict:
+    """Parse the JSON object in a single-note reply; returns {} if nothing parses."""
     if not text:
         return {}
-    # strip code fences if present
-    text = re.sub(r"^```(?:json)?\s*|\s*```$", "", text.strip(), flags=re.IGNORECASE)
-    s, e = text.find("{"), text.rfind("}")
-    if s == -1 or e == -1 or e <= s:
-        return {}
-    cand = text[s:e + 1]
-    cand = re.sub(r",\s*}", "}", cand)
-    cand = re.sub(r",\s*]", "]", cand)
+    # response_format=json_object means most replies are already valid JSON
     try:
-        return json.loads(cand)
-    except Exception:
-        cand2 = re.sub(r"[\x00-\x1f\x7f-\x9f]", " ", cand)
-        try:
-            return json.loads(cand2)
-        except Exception:
-            return {}
+        obj = orjson.loads(text)
+    except ValueError:
+        obj = None
+    if isinstance(obj, list) and len(obj) == 1:
+        obj = obj[0]  # a lone object wrapped in an array
+    if isinstance(obj, dict):
+        return obj
+    obj = _repair_loads(text, "{", "}")
+    return obj if isinstance(obj, dict) else {}
+
+
+def extract_rows(text: str):
+    """Parse a --rows-per-call reply: a {"results": [...]} object or a bare array (None if neither)."""
+    if not text:
+        return None
+    try:
+        return orjson.loads(text)
+    except ValueError:
+        pass
+    obj = _repair_loads(text, "{", "}")
+    if isinstance(obj, dict) and "results" in obj:
+        return obj
+    rows = _repair_loads(text, "[", "]")
+    return rows if rows is not None else obj
+
+
+def loads_guided(text: str):
+    """Parse a schema-guided reply; only fails if the reply was cut off by max_tokens."""
+    try:
+        return orjson.loads(text) if text else {}
+    except ValueError:
+        return {}
+
+
+def match_rows(parsed, ids) -> dict:
+    """Map a batched response ({"results": [...]} or a bare list) back to the requested ids."""
+    if parsed is None:
+        return {}
+    rows = parsed.get("results", []) if isinstance(parsed, dict) else parsed
+    wanted = set(ids)
+    out = {}
+    for row in rows if isinstance(rows, list) else []:
+        if not isinstance(row, dict):
+            continue
+        rid, pred = str(row.get("id")), row.get("pred")
+        if rid in wanted and isinstance(pred, dict) and pred:
+            out[rid] = pred
+    return out
 
 
-def call_once(endpoint, headers, model, prompt_text, max_tokens, temperature, timeout):
+async def _chat_request(session, endpoint, headers, model, prompt_text, max_tokens, temperature,
+                        guided_json=None):
     payload = {
         "model": model,
         "messages": [
-            {"role": "system",
-             "content": "You are a medical electronic records expert. Return ONLY a compact JSON object per the rules."},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": prompt_text},
         ],
         "temperature": temperature,
@@ -56,10 +166,15 @@ def call_once(endpoint, headers, model, prompt_text, max_tokens, temperature, ti
         "stream": False,
         "response_format": {"type": "json_object"}
     }
-    r = requests.post(endpoint.rstrip("/") + "/chat/completions",
-                      json=payload, headers=headers, timeout=timeout)
-    r.raise_for_status()
-    data = r.json()
+    if guided_json is not None:
+        # vLLM extension: constrain decoding to the schema instead of free-form JSON mode
+        del payload["response_format"]
+        payload["guided_json"] = guided_json
+        payload["guided_decoding_backend"] = "xgrammar"
+    async with session.post(endpoint.rstrip("/") + "/chat/completions",
+                            json=payload, headers=headers) as r:
+        r.raise_for_status()
+        data = await r.json(content_type=None)
     choices = data.get("choices", [])
     if not choices:
         return ""
@@ -67,20 +182,155 @@ def call_once(endpoint, headers, model, prompt_text, max_tokens, temperature, ti
     return msg.get("content", "") if isinstance(msg, dict) else str(msg)
 
 
-def post_completion(endpoint, api_key, model, prompt_text, max_tokens, temperature, timeout):
+async def call_once(session, endpoint, headers, model, prompt_text, max_tokens, temperature,
+                    soft_timeout=0.0, soft_retries=0, guided_json=None):
+    """One completion; attempts slower than soft_timeout are abandoned and re-sent.
+
+    Only the first soft_retries attempts are cut off at soft_timeout; the last one
+    runs until the session's hard --timeout so a genuinely slow reply still lands.
+    """
+    args = (session, endpoint, headers, model, prompt_text, max_tokens, temperature, guided_json)
+    if soft_timeout > 0:
+        for attempt in range(soft_retries):
+            try:
+                return await asyncio.wait_for(_chat_request(*args), soft_timeout)
+            except asyncio.TimeoutError:
+                await asyncio.sleep(random.uniform(0, 0.25 * 2 ** attempt))  # jittered backoff
+    return await _chat_request(*args)
+
+
+async def post_completion(session, endpoint, api_key, model, prompt_text, max_tokens, temperature,
+                          soft_timeout=0.0, soft_retries=0, guided_json=None, nid=None):
     headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
     # first try
-    txt = call_once(endpoint, headers, model, prompt_text, max_tokens, temperature, timeout)
+    txt = await call_once(session, endpoint, headers, model, prompt_text, max_tokens, temperature,
+                          soft_timeout, soft_retries, guided_json)
+    if guided_json is not None:
+        # output is already schema-valid JSON, so there is nothing to repair or retry
+        pred = loads_guided(txt)
+        return pred if isinstance(pred, dict) else {}
     pred = extract_json(txt)
     if pred:  # good
         return pred
     # one strict retry
     retry_prompt = prompt_text + "\n\nReturn ONLY a valid JSON object with the required keys. No prose."
-    txt = call_once(endpoint, headers, model, retry_prompt, max_tokens, temperature, timeout)
-    print(txt)
+    txt = await call_once(session, endpoint, headers, model, retry_prompt, max_tokens, temperature,
+                          soft_timeout, soft_retries)
+    log.debug("retry-response id=%s: %s", nid, txt)
     return extract_json(txt)
 
 
+def encode_line(nid, pred) -> bytes:
+    try:
+        return orjson.dumps({"id": nid, "pred": pred}) + b"\n"
+    except TypeError as e:  # orjson.JSONEncodeError, e.g. a lone surrogate the stdlib parser let through
+        print(f"[ERR] id={nid}: {e!r}", file=sys.stderr)
+        return orjson.dumps({"id": nid, "pred": {}}) + b"\n"
+
+
+def load_done_ids(out_path):
+    """Ids already written to out_path; a torn last line from a crash is cut off first."""
+    with out_path.open("r+b") as f:
+        data = f.read()
+        keep = data.rfind(b"\n") + 1
+        if keep < len(data):
+            f.truncate(keep)
+    done = set()
+    for line in data[:keep].splitlines():
+        if line.strip():
+            done.add(orjson.loads(line)["id"])
+    return done
+
+
+async def run(args, notes, build_prompt, out_path):
+    total = len(notes)
+    sem = asyncio.Semaphore(args.batch_size)
+    queue = asyncio.Queue()
+
+    async def single(it):
+        nid = it.get("id")
+        try:
+            pred = await post_completion(session, args.endpoint, args.api_key, args.model,
+                                         build_prompt(it.get("note", "")),
+                                         args.max_tokens, args.temperature,
+                                         args.soft_timeout, args.soft_retries,
+                                         PRED_SCHEMA if args.guided_json else None, nid=nid)
+        except Exception as e:
+            print(f"[ERR] id={nid}: {e!r}", file=sys.stderr)
+            pred = {}
+        await queue.put((nid, pred))
+
+    async def bounded(chunk):
+        if len(chunk) == 1:
+            async with sem:
+                await single(chunk[0])
+            return
+        ids = [str(it.get("id")) for it in chunk]
+        rows = [{"id": nid, "note": it.get("note", "")} for nid, it in zip(ids, chunk)]
+        headers = {"Authorization": f"Bearer {args.api_key}", "Content-Type": "application/json"}
+        async with sem:
+            try:
+                txt = await call_once(session, args.endpoint, headers, args.model,
+                                      build_prompt(orjson.dumps(rows).decode()) + BATCH_INSTRUCTIONS,
+                                      args.max_tokens * len(chunk), args.temperature,
+                                      args.soft_timeout * len(chunk), args.soft_retries,
+                                      BATCH_SCHEMA if args.guided_json else None)
+                preds = match_rows(loads_guided(txt) if args.guided_json else extract_rows(txt), ids)
+            except Exception as e:
+                print(f"[ERR] ids={ids[0]}..{ids[-1]}: {e!r}", file=sys.stderr)
+                preds = {}
+        missing = []
+        for nid, it in zip(ids, chunk):
+            if nid in preds:
+                await queue.put((it.get("id"), preds[nid]))
+            else:
+                missing.append(it)
+        # rows the model dropped or mangled go back out one note per request
+        for it in missing:
+            async with sem:
+                await single(it)
+
+    async def writer(fout):
+        # single consumer, so fout is never written from two places at once
+        done = 0
+        finished = False
+        while not finished:
+            # take whatever has piled up (up to 64) and write it in one burst
+            items = [await queue.get()]
+            while len(items) < 64 and not queue.empty():
+                items.append(queue.get_nowait())
+            if items[-1] is None:
+                items.pop()
+                finished = True
+            fout.writelines([encode_line(nid, pred) for nid, pred in items])
+            prev, done = done, done + len(items)
+            if done // args.batch_size > prev // args.batch_size or (done == total and prev < total):
+                fout.flush()
+                print(f"[INFO] processed {done}/{total}", file=sys.stderr)
+
+    connector = aiohttp.TCPConnector(limit=args.batch_size, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        with out_path.open("ab" if args.resume else "wb", buffering=1 << 20) as fout:
+            wtask = asyncio.create_task(writer(fout))
+            r = max(1, args.rows_per_call)
+            producers = asyncio.gather(*[bounded(notes[i:i + r]) for i in range(0, total, r)])
+            # the writer only finishes before its sentinel if it failed
+            await asyncio.wait([producers, wtask], return_when=asyncio.FIRST_COMPLETED)
+            if wtask.done():
+                # the writer died: stop sending requests whose results could not be saved
+                producers.cancel()
+                await asyncio.gather(producers, return_exceptions=True)
+                wtask.result()
+            try:
+                producers.result()
+            except BaseException:
+                wtask.cancel()
+                raise
+            await queue.put(None)
+            await wtask
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--model", required=True)
@@ -92,52 +342,69 @@ def main():
                                                          os.environ.get("OPENAI_API_BASE", "http://127.0.0.1:8000/v1")))
     ap.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY", "dummy"))
     ap.add_argument("--limit", type=int, default=10)  # <- default to 10 as you asked
-    ap.add_argument("--batch-size", type=int, default=50)  # <- 50 concurrent requests
-    ap.add_argument("--max-tokens", type=int, default=64)  # small JSON, keep tight
+    ap.add_argument("--batch-size", type=int, default=50,
+                    help="Max requests in flight. Not a barrier: a new note is sent as soon as any "
+                         "request finishes, so vLLM's continuous batching can refill the freed slot.")
+    ap.add_argument("--rows-per-call", type=int, default=1,
+                    help="Notes packed into one request (try 4-8; latency grows faster than linearly).")
+    ap.add_argument("--guided-json", action="store_true",
+                    help="Constrain decoding to the prediction JSON schema (vLLM guided_json).")
+    ap.add_argument("--max-tokens", type=int, default=64)  # small JSON, keep tight; scaled by --rows-per-call
     ap.add_argument("--temperature", type=float, default=0.0)
-    ap.add_argument("--timeout", type=int, default=120)
+    ap.add_argument("--timeout", type=int, default=120,
+                    help="Hard per-request ceiling in seconds.")
+    ap.add_argument("--soft-timeout", type=float, default=0.0,
+                    help="Re-send a request that takes longer than this many seconds (e.g. 2x the median "
+                         "latency); 0 disables. Scaled by --rows-per-call.")
+    ap.add_argument("--soft-retries", type=int, default=2,
+                    help="How many times a request may be re-sent after hitting --soft-timeout.")
+    ap.add_argument("--resume", action="store_true",
+                    help="Skip notes whose id is already in --out and append to it instead of overwriting.")
+    ap.add_argument("--log-level", default="WARNING", type=str.upper,
+                    choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+                    help="DEBUG shows the raw reply of every strict retry.")
     args = ap.parse_args()
+    logging.basicConfig(level=args.log_level, format="[%(levelname)s] %(message)s")
 
-    endpoint = args.endpoint
-    notes = [json.loads(l) for l in Path(args.notes).read_text(encoding="utf-8").splitlines() if l.strip()]
-    if args.limit > 0:
-        notes = notes[:args.limit]
+    notes = []
+    with open(args.notes, "rb") as f:
+        for line in f:
+            if args.limit > 0 and len(notes) >= args.limit:
+                break  # leave the rest of the file unread
+            if line.strip():
+                notes.append(orjson.loads(line))
 
-    total = len(notes)
-    if total == 0:
+    if len(notes) == 0:
         print("[ERR] no items to process", file=sys.stderr);
         sys.exit(1)
 
-    prompt_t = Path(args.prompt_template).read_text(encoding="utf-8")
+    out_path = Path(args.out)
+    if args.resume and out_path.exists():
+        done_ids = load_done_ids(out_path)
+        notes = [it for it in notes if it.get("id") not in done_ids]
+        print(f"[INFO] resume: {len(done_ids)} ids already in {out_path}", file=sys.stderr)
+        if not notes:
+            print("[DONE] nothing left to process", file=sys.stderr)
+            return
+
+    # trailing whitespace is dropped so the note always lands right after the shared prefix
+    prompt_t = Path(args.prompt_template).read_text(encoding="utf-8").rstrip()
+    if not prompt_t.endswith("{{NOTE_TEXT}}"):
+        print("[WARN] prompt template does not end with {{NOTE_TEXT}}; text after it is not "
+              "shared across requests by vLLM's prefix cache", file=sys.stderr)
+
+    # Split once around the placeholder so each call is a plain concat, not a scan of the template
+    prefix, _, suffix = prompt_t.partition("{{NOTE_TEXT}}")
 
     def build_prompt(note_text: str) -> str:
         # Use the strict template with rules & example; inject the note
-        return prompt_t.replace("{{NOTE_TEXT}}", note_text)
+        return prefix + note_text + suffix if suffix else prefix + note_text
 
-    out_path = Path(args.out)
     out_path.parent.mkdir(parents=True, exist_ok=True)
 
+    total = len(notes)
     t0 = time.perf_counter()
-    with out_path.open("w", encoding="utf-8") as fout:
-        for i in range(0, total, args.batch_size):
-            batch = notes[i:i + args.batch_size]
-            with ThreadPoolExecutor(max_workers=len(batch)) as ex:
-                futs = {}
-                for it in batch:
-                    nid = it.get("id")
-                    ptxt = build_prompt(it.get("note", ""))
-                    fut = ex.submit(post_completion, endpoint, args.api_key, args.model,
-                                    ptxt, args.max_tokens, args.temperature, args.timeout)
-                    futs[fut] = nid
-                for fut in as_completed(futs):
-                    nid = futs[fut]
-                    try:
-                        pred = fut.result()
-                    except Exception as e:
-                        print(f"[ERR] id={nid}: {e}", file=sys.stderr)
-                        pred = {}
-                    fout.write(json.dumps({"id": nid, "pred": pred}, ensure_ascii=False) + "\n")
-            print(f"[INFO] processed {min(i + args.batch_size, total)}/{total}", file=sys.stderr)
+    asyncio.run(run(args, notes, build_prompt, out_path))
 
     print(f"[DONE] {total} items in {time.perf_counter() - t0:.2f}s", file=sys.stderr)
 